@@ -1,38 +1,187 @@
+import argparse
+import hashlib
 import os
+import re
+import shutil
 import sys
+import tempfile
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 from transformer import Transformer
 
+# Files without any subscripted Union or Optional have nothing to rewrite.
+SUBSCRIPT_PATTERN = re.compile(rb"\b(?:Union|Optional)\s*\[")
 
-def rewrite_file(full_path):
+# Maximum number of digests kept in the cache, dropping the least
+# recently seen ones first.
+MAX_CACHE_SIZE = 100_000
+
+# Transformer reused for all files rewritten by this process.
+transformer: Transformer | None = None
+# SHA-256 digests of sources that a previous run left unchanged.
+unchanged_digests: frozenset[str] = frozenset()
+
+
+def set_unchanged_digests(digests: frozenset[str]) -> None:
+    global unchanged_digests
+    unchanged_digests = digests
+
+
+def get_cache_path() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "pep604-converter", "unchanged.txt")
+
+
+def get_cache_key() -> str:
+    """
+    Get the key the cache is valid for. Both the Python version and the
+    transformer's code determine whether a source is left unchanged.
+    """
+    with open(sys.modules[Transformer.__module__].__file__, "rb") as f:
+        transformer_digest = hashlib.sha256(f.read()).hexdigest()
+    return f"py{sys.version_info[0]}.{sys.version_info[1]}-{transformer_digest}"
+
+
+def load_cache(cache_path: str, key: str) -> list[str]:
+    """
+    Load the cached digests, least recently seen first. The cache is
+    empty if it was written for a different key.
+    """
+    try:
+        with open(cache_path) as f:
+            cache_key, *digests = f.read().split()
+    except (FileNotFoundError, ValueError):
+        return []
+    return digests if cache_key == key else []
+
+
+def save_cache(cache_path: str, key: str, digests: Iterable[str]) -> None:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cache_path))
+    try:
+        with open(fd, "w") as f:
+            f.write("\n".join([key, *digests]))
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def rewrite_file(
+    full_path, cache: bool = False
+) -> str | None:
+    """
+    Rewrite the file at `full_path`. With `cache`, the digest of its
+    contents is returned if it was parsed but did not need to be changed.
+    """
+    global transformer
+    with open(full_path, "rb") as f:
+        data = f.read()
+    # Only files subscripting the rewritable types can change, so skip
+    # parsing everything else.
+    if not SUBSCRIPT_PATTERN.search(data):
+        return None
+    digest = None
+    if cache:
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in unchanged_digests:
+            return digest
     print(f"Rewriting {full_path}")
-    with open(full_path) as f:
-        source = f.read()
-    transformer = Transformer(source)
+    # Translate newlines like reading in text mode would.
+    original = data.decode().replace("\r\n", "\n").replace("\r", "\n")
+    if transformer is None:
+        transformer = Transformer(original)
+    else:
+        transformer.reset(original)
     source = transformer.transform()
-    with open(full_path, "w") as f:
-        f.write(source)
+    if source == original:
+        return digest
+    # Keep Windows line endings.
+    if b"\r\n" in data:
+        source = source.replace("\n", "\r\n")
+    # Write to a temporary file first, so that the original is never
+    # left half written. Symlinks are resolved to replace their target
+    # rather than the link itself.
+    real_path = os.path.realpath(full_path)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(real_path))
+    try:
+        with open(fd, "wb") as f:
+            f.write(source.encode())
+        shutil.copymode(real_path, tmp_path)
+        os.replace(tmp_path, real_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return None
+
+
+def iter_py_files(path: str):
+    # `os.scandir` entries carry the file type, saving a `stat` per
+    # entry compared to `os.walk`.
+    try:
+        it = os.scandir(path)
+    except OSError:
+        # Skip unreadable directories, like `os.walk` does.
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_py_files(entry.path)
+            elif entry.name.endswith(".py") and entry.is_file():
+                yield entry.path
 
 
-def main(path: str):
+def main(path: str, cache: bool = False):
     if not os.path.exists(path):
         raise ValueError(f"{path} not found")
+    if cache:
+        cache_path = get_cache_path()
+        cache_key = get_cache_key()
+        cached_digests = load_cache(cache_path, cache_key)
+        set_unchanged_digests(frozenset(cached_digests))
     if os.path.isfile(path):
-        rewrite_file(path)
+        digests = [rewrite_file(path, cache)]
     else:
-        for root, _, files in os.walk(path):
-            for file in files:
-                if os.path.splitext(file)[1] == ".py":
-                    full_path = os.path.join(root, file)
-                    print(f"Rewriting {full_path}")
-                    with open(full_path) as f:
-                        source = f.read()
-                    transformer = Transformer(source)
-                    source = transformer.transform()
-                    with open(full_path, "w") as f:
-                        f.write(source)
+        paths = list(iter_py_files(path))
+        # Files are independent and rewriting is CPU-bound, so spread
+        # them over all cores.
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            initializer=set_unchanged_digests,
+            initargs=(unchanged_digests,),
+        ) as executor:
+            digests = list(
+                executor.map(
+                    partial(rewrite_file, cache=cache),
+                    paths,
+                    chunksize=16,
+                )
+            )
+    if cache:
+        # Move the digests seen in this run to the end, so that stale
+        # ones are the first to be dropped.
+        seen_digests = dict.fromkeys(digest for digest in digests if digest)
+        new_cached_digests = [
+            digest for digest in cached_digests if digest not in seen_digests
+        ]
+        new_cached_digests.extend(seen_digests)
+        new_cached_digests = new_cached_digests[-MAX_CACHE_SIZE:]
+        if new_cached_digests != cached_digests:
+            save_cache(cache_path, cache_key, new_cached_digests)
 
 
 if __name__ == "__main__":
-    path = sys.argv[1]
-    main(path)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="remember files that did not need changes, so that later runs "
+        "can skip them without parsing",
+    )
+    args = parser.parse_args()
+    main(args.path, args.cache)
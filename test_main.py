@@ -0,0 +1,148 @@
+import hashlib
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import main
+from main import (
+    get_cache_key,
+    get_cache_path,
+    iter_py_files,
+    load_cache,
+    rewrite_file,
+    save_cache,
+    set_unchanged_digests,
+)
+
+SOURCE = "from typing import Optional\nx: Optional[int]\n"
+EXPECTED = "x: int | None\n"
+UNCHANGED_SOURCE = 'from typing import Optional\nx: Optional["T"]\n'
+
+
+def sha256(source: str) -> str:
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp_dir.cleanup)
+        self.tmp_dir = self._tmp_dir.name
+
+    def write(self, name: str, source: str) -> str:
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w") as f:
+            f.write(source)
+        return path
+
+    def read(self, path: str) -> str:
+        with open(path) as f:
+            return f.read()
+
+
+class RewriteFileTest(TempDirTestCase):
+    def test_rewrites_symlink_target(self):
+        real_path = self.write("real.py", SOURCE)
+        link_path = os.path.join(self.tmp_dir, "link.py")
+        os.symlink(real_path, link_path)
+        rewrite_file(link_path)
+        self.assertTrue(os.path.islink(link_path))
+        self.assertEqual(self.read(real_path), EXPECTED)
+
+    def test_keeps_permissions(self):
+        path = self.write("mod.py", SOURCE)
+        os.chmod(path, 0o777)
+        rewrite_file(path)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o777)
+        self.assertEqual(self.read(path), EXPECTED)
+
+    def test_keeps_windows_line_endings(self):
+        path = os.path.join(self.tmp_dir, "mod.py")
+        with open(path, "wb") as f:
+            f.write(SOURCE.replace("\n", "\r\n").encode())
+        rewrite_file(path)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), EXPECTED.replace("\n", "\r\n").encode())
+
+    def test_keeps_existing_tmp_file(self):
+        path = self.write("mod.py", SOURCE)
+        tmp_path = self.write("mod.py.tmp", "keep me")
+        rewrite_file(path)
+        self.assertEqual(self.read(tmp_path), "keep me")
+        self.assertEqual(self.read(path), EXPECTED)
+
+    def test_removes_tmp_file_on_failure(self):
+        path = self.write("mod.py", SOURCE)
+        with mock.patch("shutil.copymode", side_effect=OSError):
+            with self.assertRaises(OSError):
+                rewrite_file(path)
+        self.assertEqual(os.listdir(self.tmp_dir), ["mod.py"])
+        self.assertEqual(self.read(path), SOURCE)
+
+    def test_skips_unreadable_directories(self):
+        path = self.write("a.py", "")
+        locked = os.path.join(self.tmp_dir, "locked")
+        os.mkdir(locked)
+        scandir = os.scandir
+
+        def locked_scandir(path):
+            if path == locked:
+                raise PermissionError(path)
+            return scandir(path)
+
+        with mock.patch("os.scandir", locked_scandir):
+            self.assertEqual(list(iter_py_files(self.tmp_dir)), [path])
+
+class CacheTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        environ = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.tmp_dir})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.addCleanup(set_unchanged_digests, frozenset())
+        self.src_dir = os.path.join(self.tmp_dir, "src")
+        os.mkdir(self.src_dir)
+
+    def load(self) -> list[str]:
+        return load_cache(get_cache_path(), get_cache_key())
+
+    def test_digest_only_with_cache(self):
+        path = self.write("mod.py", UNCHANGED_SOURCE)
+        self.assertIsNone(rewrite_file(path))
+        self.assertEqual(rewrite_file(path, cache=True), sha256(UNCHANGED_SOURCE))
+
+    def test_skips_cached_file(self):
+        path = self.write("mod.py", SOURCE)
+        set_unchanged_digests(frozenset([sha256(SOURCE)]))
+        self.assertEqual(rewrite_file(path, cache=True), sha256(SOURCE))
+        self.assertEqual(self.read(path), SOURCE)
+
+    def test_round_trip(self):
+        self.write("src/unchanged.py", UNCHANGED_SOURCE)
+        changed_path = self.write("src/changed.py", SOURCE)
+        main.main(self.src_dir, cache=True)
+        # Only the unchanged file is recorded, not the rewritten one.
+        self.assertEqual(self.load(), [sha256(UNCHANGED_SOURCE)])
+        self.assertEqual(self.read(changed_path), EXPECTED)
+        # Cached files are skipped without being transformed.
+        with mock.patch.object(
+            main.Transformer, "transform", side_effect=AssertionError
+        ):
+            main.main(os.path.join(self.src_dir, "unchanged.py"), cache=True)
+
+    def test_ignores_cache_for_other_key(self):
+        save_cache(get_cache_path(), "other", [sha256(UNCHANGED_SOURCE)])
+        self.assertEqual(self.load(), [])
+
+    def test_drops_least_recently_seen(self):
+        save_cache(get_cache_path(), get_cache_key(), ["old", "older"])
+        path = self.write("src/unchanged.py", UNCHANGED_SOURCE)
+        with mock.patch("main.MAX_CACHE_SIZE", 2):
+            main.main(path, cache=True)
+        self.assertEqual(self.load(), ["older", sha256(UNCHANGED_SOURCE)])
+
+
+if __name__ == "__main__":
+    unittest.main()
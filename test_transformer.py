@@ -0,0 +1,72 @@
+import unittest
+
+from transformer import Rewriter, Transformer
+
+
+class RewriterTest(unittest.TestCase):
+    def test_extract_applies_inner_substitutions(self):
+        rewriter = Rewriter("x = f(a, b)\ny = 1")
+        rewriter.substitute(1, 1, 6, 7, "A")
+        rewriter.substitute(1, 1, 9, 10, "B")
+        self.assertEqual(rewriter.extract(1, 1, 4, 11, 0), "f(A, B)")
+        self.assertEqual(rewriter.operations, [])
+
+    def test_extract_only_takes_operations_since_first_op(self):
+        rewriter = Rewriter("x = f(a)\ny = g(b)")
+        rewriter.substitute(1, 1, 6, 7, "A")
+        rewriter.substitute(2, 2, 6, 7, "B")
+        self.assertEqual(rewriter.extract(2, 2, 4, 8, 1), "g(B)")
+        self.assertEqual(len(rewriter.operations), 1)
+
+    def test_extract_non_ascii(self):
+        rewriter = Rewriter("x = f('é', a)")
+        # Column offsets count UTF-8 bytes, like in the AST.
+        rewriter.substitute(1, 1, 12, 13, "A")
+        self.assertEqual(rewriter.extract(1, 1, 4, 14, 0), "f('é', A)")
+
+
+class TransformerTest(unittest.TestCase):
+    def assertTransforms(self, source: str, expected: str) -> None:
+        self.assertEqual(Transformer(source).transform(), expected)
+
+    def test_non_ascii_line(self):
+        self.assertTransforms(
+            "from typing import Optional, Literal\n"
+            "x: Optional[Literal['é']]\n"
+            "y = 1\n",
+            "from typing import Literal\nx: Literal['é'] | None\ny = 1\n",
+        )
+
+    def test_non_ascii_before_end_of_line(self):
+        self.assertTransforms(
+            "from typing import Optional\nx: Optional['é'.__class__]\ny = 1\n",
+            "x: 'é'.__class__ | None\ny = 1\n",
+        )
+
+    def test_nested_non_ascii(self):
+        self.assertTransforms(
+            "from typing import Optional, List\nx: Optional[List['é']]\n",
+            "from typing import List\nx: List['é'] | None\n",
+        )
+
+    def test_non_ascii_before_union_members(self):
+        self.assertTransforms(
+            "x = 'é'; y: Union[int, str]\n",
+            "x = 'é'; y: int | str\n",
+        )
+
+    def test_keep_typing_import_for_union_member(self):
+        self.assertTransforms(
+            "import typing\nx: typing.Optional[typing.Any]\n",
+            "import typing\nx: typing.Any | None\n",
+        )
+
+    def test_relative_typing_import(self):
+        self.assertTransforms(
+            "from .typing import Optional, List\nx: Optional[List[int]]\n",
+            "from .typing import List\nx: List[int] | None\n",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,21 +1,25 @@
 import ast
-import copy
-import re
-from bisect import bisect
-from collections.abc import Generator
-from contextlib import contextmanager
+import sys
+from collections.abc import Callable
 from dataclasses import dataclass
+from itertools import accumulate
+from operator import attrgetter
 from typing import Final, Literal
 
 RemovedTyping = Literal["Union", "Optional"]
 
+# Identifiers in the AST are interned by the parser, so they can be
+# compared by identity against these.
+UNION: Final[str] = sys.intern("Union")
+OPTIONAL: Final[str] = sys.intern("Optional")
 
-@dataclass
+
+@dataclass(slots=True)
 class DeleteLine:
     lineno: int
 
 
-@dataclass
+@dataclass(slots=True)
 class Substitution:
     lineno: int
     end_lineno: int
@@ -32,6 +36,26 @@ class ConflictingOperationsException(Exception):
 FULL_LINE: Final[int] = -1
 
 
+def is_rewritable(name: str) -> bool:
+    """Check whether the identifier `name` from the AST is Union or Optional."""
+    return name is UNION or name is OPTIONAL
+
+
+def format_alias(alias: ast.alias) -> str:
+    return f"{alias.name} as {alias.asname}" if alias.asname else alias.name
+
+
+def format_import(node: ast.Import) -> str:
+    """Format an `import ...` without `ast.unparse`."""
+    return f"import {', '.join(map(format_alias, node.names))}"
+
+
+def format_import_from(node: ast.ImportFrom) -> str:
+    """Format a `from ... import ...` without `ast.unparse`."""
+    module = "." * node.level + (node.module or "")
+    return f"from {module} import {', '.join(map(format_alias, node.names))}"
+
+
 class Rewriter:
     """
     Allow the rewriting of the source file without having to keep track
@@ -40,12 +64,33 @@ class Rewriter:
     """
 
     def __init__(self, source: str) -> None:
-        self.source: str = source
         self.operations: list[Substitution] = []
+        self.reset(source)
 
-    @staticmethod
-    def _sort_key(op: Substitution) -> tuple[int, int]:
-        return op.lineno, op.col_offset
+    def reset(self, source: str) -> None:
+        """Prepare the rewriter for a new source, reusing its buffers."""
+        self.source: str = source
+        lines = source.split("\n")
+        # Offset of the start of each line in `source`, plus the offset
+        # one past the end, to convert line and column numbers into
+        # absolute offsets.
+        self._line_starts: list[int] = [
+            0,
+            *accumulate(len(line) + 1 for line in lines),
+        ]
+        # UTF-8 encoding of the non-ASCII lines, on which the byte based
+        # column offsets of the AST differ from character offsets.
+        self._encoded_lines: dict[int, bytes] = {}
+        if not source.isascii():
+            for lineno, line in enumerate(lines, 1):
+                if not line.isascii():
+                    self._encoded_lines[lineno] = line.encode()
+        self.operations.clear()
+
+    # Implemented in C, unlike an equivalent function returning a tuple.
+    _sort_key: Final[Callable[[Substitution], tuple[int, int]]] = attrgetter(
+        "lineno", "col_offset"
+    )
 
     def _check_overlaps(self, a: Substitution, b: Substitution):
         """
@@ -72,32 +117,78 @@ class Rewriter:
             end_col_offset=end_col_offset,
             text=text,
         )
-        idx = bisect(self.operations, self._sort_key(op), key=self._sort_key)
-        if idx > 0:
-            self._check_overlaps(self.operations[idx - 1], op)
-        if idx < len(self.operations):
-            self._check_overlaps(op, self.operations[idx])
-        self.operations.insert(idx, op)
+        # Operations are only sorted and checked for overlaps once they
+        # are applied.
+        self.operations.append(op)
+
+    def _offset(self, lineno: int, col_offset: int) -> int:
+        """
+        Convert a line number and UTF-8 byte column offset, as found in
+        the AST, into an absolute character offset into the source.
+        """
+        encoded_line = self._encoded_lines.get(lineno)
+        if encoded_line is not None:
+            col_offset = len(encoded_line[:col_offset].decode())
+        return self._line_starts[lineno - 1] + col_offset
+
+    def _sort_operations(self, operations: list[Substitution]) -> None:
+        operations.sort(key=self._sort_key)
+        for a, b in zip(operations, operations[1:]):
+            self._check_overlaps(a, b)
+
+    def extract(
+        self,
+        lineno: int,
+        end_lineno: int,
+        col_offset: int,
+        end_col_offset: int,
+        first_op: int,
+    ) -> str:
+        """
+        Get the source between two positions with the substitutions
+        inside of it applied, i.e. all substitutions made since there
+        were `first_op` operations. Those substitutions are removed, so
+        that the range can then be substituted as a whole.
+        """
+        operations = self.operations[first_op:]
+        self._sort_operations(operations)
+        parts: list[str] = []
+        cur = self._offset(lineno, col_offset)
+        for op in operations:
+            parts.append(self.source[cur : self._offset(op.lineno, op.col_offset)])
+            parts.append(op.text)
+            cur = self._offset(op.end_lineno, op.end_col_offset)
+        parts.append(self.source[cur : self._offset(end_lineno, end_col_offset)])
+        del self.operations[first_op:]
+        return "".join(parts)
 
     def get_result(self) -> str:
-        lines = self.source.split("\n")
-        for op in reversed(self.operations):
+        """
+        Apply all substitutions in a single forward pass over the source,
+        joining the unchanged spans and replacement texts only once.
+        """
+        self._sort_operations(self.operations)
+        parts: list[str] = []
+        cur = 0
+        for op in self.operations:
+            start = self._offset(op.lineno, op.col_offset)
+            end = self._offset(op.end_lineno, op.end_col_offset)
             if (
                 not op.text
                 and op.lineno == op.end_lineno
                 and op.col_offset == 0
-                and op.end_col_offset == len(lines[op.lineno - 1])
+                and end == self._line_starts[op.lineno] - 1
             ):
-                del lines[op.lineno - 1]
-            else:
-                lines[op.lineno - 1] = (
-                    lines[op.lineno - 1][: op.col_offset]
-                    + op.text
-                    + lines[op.end_lineno - 1][op.end_col_offset :]
-                )
-                for lineno in range(op.end_lineno, op.lineno, -1):
-                    del lines[lineno - 1]
-        return "\n".join(lines)
+                # Delete the full line, including its line break.
+                if end < len(self.source):
+                    end += 1
+                elif start > 0:
+                    start -= 1
+            parts.append(self.source[cur:start])
+            parts.append(op.text)
+            cur = end
+        parts.append(self.source[cur:])
+        return "".join(parts)
 
 
 class Transformer(ast.NodeTransformer):
@@ -107,7 +198,6 @@ class Transformer(ast.NodeTransformer):
     """
 
     _parent: ast.AST | None = None
-    rewritable_types: Final[set[RemovedTyping]] = {"Union", "Optional"}
     # Nodes types that do not need to be processed further, i.e. need
     # no recursion or unparsing.
     as_is_node_types: Final[tuple[type[ast.AST], ...]] = (
@@ -115,38 +205,86 @@ class Transformer(ast.NodeTransformer):
         ast.Name,
         ast.Attribute,
     )
+    # Statements whose source contains none of these can't contain
+    # anything that needs to be rewritten or tracked.
+    relevant_names: Final[tuple[str, ...]] = ("Union", "Optional", "typing")
 
-    def __init__(self, source: str, node: ast.AST | None = None) -> None:
+    def __init__(self, source: str) -> None:
         super().__init__()
-        # List of typing imports encountered during the `visit` pass
-        # that may need to be rewritten.
-        self._import_froms: set[ast.ImportFrom] = set()
-        self._imports: set[ast.Import] = set()
+        # Typing imports encountered during the `visit` pass that may
+        # need to be rewritten, keyed by `id` and in visiting order.
+        self._import_froms: dict[int, ast.ImportFrom] = {}
+        self._imports: dict[int, ast.Import] = {}
+        # Keeps track of types that were used in such a way that it
+        # couldn't be rewritten, meaning we can't remove the import.
+        self._keep_imports_for: set[RemovedTyping] = set()
+        self._rewriter: Rewriter = Rewriter("")
+        self._visitors: dict[type[ast.AST], Callable[[ast.AST], ast.AST]] = {}
+        self.reset(source)
+
+    def reset(self, source: str) -> None:
+        """
+        Prepare the transformer for a new source, so a single instance
+        can be reused across files.
+        """
+        self._import_froms.clear()
+        self._imports.clear()
         # Whether an attribute was accessed on typing that was not
         # one of the replaceable, meaning the import can't be
         # removed.
         self._other_attrs_encountered = False
-        # Keeps track of types that were used in such a way that it
-        # couldn't be rewritten, meaning we can't remove the import.
-        self._keep_imports_for: set[RemovedTyping] = set()
+        self._keep_imports_for.clear()
+        self._parent = None
         self._source: str = source
-        self._rewriter: Rewriter = Rewriter(source)
-        self.tree = node or ast.parse(source, filename="<string>", mode="exec")
+        # Sources that don't mention the rewritable types can't change,
+        # so they aren't even parsed.
+        self.tree: ast.AST | None = None
+        if UNION in source or OPTIONAL in source:
+            self._rewriter.reset(source)
+            self.tree = ast.parse(source, filename="<string>", mode="exec")
 
     def visit(self, node: ast.AST) -> ast.AST:
         # Keep track of parent nodes.
         node.parent = self._parent
         old_parent = self._parent
         self._parent = node
-        node = super().visit(node)
+        # Look up the visitor by node type once, rather than building and
+        # looking up its name for every node like `NodeVisitor.visit`.
+        node_type = type(node)
+        visitor = self._visitors.get(node_type)
+        if visitor is None:
+            visitor = getattr(self, f"visit_{node_type.__name__}", self.generic_visit)
+            self._visitors[node_type] = visitor
+        node = visitor(node)
         self._parent = old_parent
         return node
 
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        if isinstance(node, ast.stmt) and not self._may_be_relevant(node):
+            return node
+        return super().generic_visit(node)
+
+    def _may_be_relevant(self, node: ast.stmt) -> bool:
+        """
+        Cheaply check whether the lines spanned by the statement
+        `node`, including any decorators, mention any of the relevant
+        names, so irrelevant statements can be skipped entirely.
+        """
+        lineno = min(
+            [node.lineno, *(d.lineno for d in getattr(node, "decorator_list", ()))]
+        )
+        start = self._rewriter._offset(lineno, 0)
+        end = self._rewriter._offset(node.end_lineno + 1, 0)
+        segment = self._source[start:end]
+        return any(name in segment for name in self.relevant_names)
+
     def transform(self) -> str:
+        if self.tree is None:
+            return self._source
         self.visit(self.tree)
         self.rewrite_imports()
         source = self._rewriter.get_result()
-        return re.sub("^\n+", "", source)
+        return source.lstrip("\n")
 
     def rewrite_imports(self):
         """
@@ -155,112 +293,146 @@ class Transformer(ast.NodeTransformer):
         been processed.
         """
         if not self._other_attrs_encountered:
-            for import_node in self._imports:
-                import_node.names = [
-                    alias for alias in import_node.names if alias.name != "typing"
-                ]
-                if not import_node.names:
-                    self.substitute(import_node, "")
-                else:
-                    self.substitute(import_node, ast.unparse(import_node))
-        for import_from_node in self._import_froms:
-            old_names = import_from_node.names
-            import_from_node.names = [
+            for import_node in self._imports.values():
+                self.prune_import(
+                    import_node,
+                    [alias for alias in import_node.names if alias.name != "typing"],
+                )
+        for import_from_node in self._import_froms.values():
+            names = [
                 alias
                 for alias in import_from_node.names
-                if alias.name not in self.rewritable_types
+                if not is_rewritable(alias.name)
                 or alias.name in self._keep_imports_for
             ]
-            if len(old_names) != len(import_from_node.names):
-                if not import_from_node.names:
-                    self.substitute(import_from_node, "")
-                else:
-                    self.substitute(import_from_node, ast.unparse(import_from_node))
+            if len(names) != len(import_from_node.names):
+                self.prune_import(import_from_node, names)
+
+    def prune_import(
+        self, node: ast.Import | ast.ImportFrom, names: list[ast.alias]
+    ) -> None:
+        """
+        Reduce the names imported by `node` to `names`, removing the
+        import entirely if no names are left.
+        """
+        node.names = names
+        if not names:
+            self.substitute(node, "")
+        elif isinstance(node, ast.ImportFrom):
+            self.substitute(node, format_import_from(node))
+        else:
+            self.substitute(node, format_import(node))
+
+    def _segment(self, node: ast.AST) -> str:
+        """Get the source segment of `node`."""
+        start = self._rewriter._offset(node.lineno, node.col_offset)
+        end = self._rewriter._offset(node.end_lineno, node.end_col_offset)
+        return self._source[start:end]
+
+    def _rewritten_segment(self, node: ast.AST) -> str:
+        """
+        Get the source segment of `node` with any nested Unions and
+        Optionals in it rewritten.
+        """
+        if isinstance(node, self.as_is_node_types):
+            # Nothing needs to be rewritten, but uses of typing
+            # attributes still need to be tracked.
+            self.visit(node)
+            return self._segment(node)
+        first_op = len(self._rewriter.operations)
+        self.visit(node)
+        return self._rewriter.extract(
+            node.lineno,
+            node.end_lineno,
+            node.col_offset,
+            node.end_col_offset,
+            first_op,
+        )
 
     def substitute(self, node: ast.AST, text: str) -> None:
-        self._has_changes = True
         self._rewriter.substitute(
             node.lineno, node.end_lineno, node.col_offset, node.end_col_offset, text
         )
 
     def visit_Import(self, node: ast.Import) -> ast.AST:
         if any(name.name == "typing" for name in node.names):
-            self._imports.add(node)
+            self._imports[id(node)] = node
             return node
         return self.generic_visit(node)
 
     def visit_ImportFrom(self, node: ast.ImportFrom) -> ast.AST:
         if node.module == "typing":
-            if any(alias.name in self.rewritable_types for alias in node.names):
-                self._import_froms.add(node)
+            if any(is_rewritable(alias.name) for alias in node.names):
+                self._import_froms[id(node)] = node
                 return node
         return self.generic_visit(node)
 
-    def visit_Subscript(self, node: ast.Subscript):
-        if isinstance(node.ctx, ast.Load):
-            lhs = ""
-            if isinstance(node.value, ast.Name):
-                lhs = node.value.id
-            elif (
-                isinstance(node.value, ast.Attribute)
-                and isinstance(node.value.value, ast.Name)
-                and node.value.value.id == "typing"
+    def _union_members(
+        self, node: ast.Subscript
+    ) -> tuple[list[ast.expr], bool] | None:
+        """
+        Get the members of the union that `node` represents and whether
+        None is one of them, or None if `node` is not a rewritable
+        Union or Optional.
+        """
+        # Cheap type checks first, as this runs for every subscript.
+        if type(node.ctx) is not ast.Load:
+            return None
+        value = node.value
+        value_type = type(value)
+        if value_type is ast.Name:
+            lhs = value.id
+        elif (
+            value_type is ast.Attribute
+            and type(value.value) is ast.Name
+            and value.value.id == "typing"
+        ):
+            lhs = value.attr
+        else:
+            return None
+        if lhs is OPTIONAL:
+            if isinstance(node.slice, ast.Constant) and isinstance(
+                node.slice.value, str
             ):
-                lhs = node.value.attr
-            if lhs and lhs in self.rewritable_types:
-                if lhs == "Optional":
-                    if isinstance(node.slice, ast.Constant) and isinstance(
-                        node.slice.value, str
-                    ):
-                        # Optional["T"].
-                        self._keep_imports_for.add("Optional")
-                    else:
-                        # Optional[T].
-                        if isinstance(node.slice, self.as_is_node_types):
-                            sub_str = ast.get_source_segment(self._source, node.slice)
-                        else:
-                            with self.sub_transformer(node.slice) as sub_transformer:
-                                sub_str = sub_transformer.transform()
-                        self.substitute(node, f"{sub_str} | None")
-                        return node
-                elif lhs == "Union":
-                    if isinstance(node.slice, ast.Tuple):
-                        if any(
-                            isinstance(elt, ast.Constant) and isinstance(elt.value, str)
-                            for elt in node.slice.elts
-                        ):
-                            # Union[X, "Y"]
-                            self._keep_imports_for.add("Union")
-                        else:
-                            # Union[X, Y]
-                            sub_strs: list[str] = []
-                            for name in node.slice.elts:
-                                if isinstance(node.slice, self.as_is_node_types):
-                                    sub_strs.append(
-                                        ast.get_source_segment(self._source, name)
-                                    )
-                                else:
-                                    with self.sub_transformer(name) as sub_transformer:
-                                        sub_strs.append(sub_transformer.transform())
-                            self.substitute(node, " | ".join(sub_strs))
-                            return node
-                    elif isinstance(node.slice, ast.Constant):
-                        # Union["X"].
-                        self._keep_imports_for.add("Union")
-                    else:
-                        # Union[X].
-                        self.substitute(
-                            node,
-                            ast.get_source_segment(self._source, node.slice),
-                        )
-                        return node
-        return self.generic_visit(node)
+                # Optional["T"].
+                self._keep_imports_for.add("Optional")
+            else:
+                # Optional[T].
+                return [node.slice], True
+        elif lhs is UNION:
+            if isinstance(node.slice, ast.Tuple):
+                if any(
+                    isinstance(elt, ast.Constant) and isinstance(elt.value, str)
+                    for elt in node.slice.elts
+                ):
+                    # Union[X, "Y"]
+                    self._keep_imports_for.add("Union")
+                else:
+                    # Union[X, Y]
+                    return node.slice.elts, False
+            elif isinstance(node.slice, ast.Constant):
+                # Union["X"].
+                self._keep_imports_for.add("Union")
+            else:
+                # Union[X].
+                return [node.slice], False
+        return None
+
+    def visit_Subscript(self, node: ast.Subscript) -> ast.AST:
+        members = self._union_members(node)
+        if members is None:
+            return self.generic_visit(node)
+        elts, optional = members
+        text = " | ".join(map(self._rewritten_segment, elts))
+        self.substitute(node, f"{text} | None" if optional else text)
+        return node
 
     def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        value = node.value
         if (
-            isinstance(node.value, ast.Name)
-            and node.value.id == "typing"
-            and node.attr not in self.rewritable_types
+            type(value) is ast.Name
+            and value.id == "typing"
+            and not is_rewritable(node.attr)
         ):
             self._other_attrs_encountered = True
         return self.generic_visit(node)
@@ -272,45 +444,9 @@ class Transformer(ast.NodeTransformer):
         import remains.
         """
         if (
-            node.id in self.rewritable_types
+            is_rewritable(node.id)
             and node.parent and not isinstance(node.parent, ast.Subscript)
         ):
             self._keep_imports_for.add(node.id)
         return self.generic_visit(node)
 
-    @contextmanager
-    def sub_transformer(self, node: ast.AST) -> Generator["Transformer", None, None]:
-        sub_tree = copy.deepcopy(node)
-        ast.increment_lineno(sub_tree, -sub_tree.lineno + 1)
-        DedentTransformer().transform(sub_tree)
-        source = ast.get_source_segment(self._source, node)
-        assert source is not None, f"Could not determine source segment for {node}"
-        transformer = Transformer(source, sub_tree)
-        yield transformer
-        self._import_froms.update(transformer._import_froms)
-        self._imports.update(transformer._imports)
-        self._keep_imports_for.update(transformer._keep_imports_for)
-        self._other_attrs_encountered = (
-            self._other_attrs_encountered or transformer._other_attrs_encountered
-        )
-
-
-class DedentTransformer(ast.NodeTransformer):
-    """
-    Transformer to move the col_offset of a node to the start of the
-    line, moving nodes behind it up as well.
-    """
-
-    def transform(self, node: ast.AST) -> None:
-        self._n: int = node.col_offset
-        self._lineno: int = node.lineno
-        self.visit(node)
-
-    def visit(self, node: ast.AST) -> ast.AST:
-        if (lineno := getattr(node, "lineno", None)) and lineno == self._lineno:
-            node.col_offset -= self._n
-        if (
-            end_lineno := getattr(node, "end_lineno", None)
-        ) and end_lineno == self._lineno:
-            node.end_col_offset -= self._n
-        return super().visit(node)